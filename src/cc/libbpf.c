@@ -1057,9 +1057,10 @@ int bpf_detach_tracepoint(const char *tp_category, const char *tp_name) {
   return 0;
 }
 
-void * bpf_open_perf_buffer(perf_reader_raw_cb raw_cb,
-                            perf_reader_lost_cb lost_cb, void *cb_cookie,
-                            int pid, int cpu, int page_cnt) {
+void * bpf_open_perf_buffer_wakeup(perf_reader_raw_cb raw_cb,
+                                   perf_reader_lost_cb lost_cb, void *cb_cookie,
+                                   int pid, int cpu, int page_cnt,
+                                   int wakeup_events) {
   int pfd;
   struct perf_event_attr attr = {};
   struct perf_reader *reader = NULL;
@@ -1072,7 +1073,7 @@ void * bpf_open_perf_buffer(perf_reader_raw_cb raw_cb,
   attr.type = PERF_TYPE_SOFTWARE;
   attr.sample_type = PERF_SAMPLE_RAW;
   attr.sample_period = 1;
-  attr.wakeup_events = 1;
+  attr.wakeup_events = wakeup_events;
   pfd = syscall(__NR_perf_event_open, &attr, pid, cpu, -1, PERF_FLAG_FD_CLOEXEC);
   if (pfd < 0) {
     fprintf(stderr, "perf_event_open: %s\n", strerror(errno));
@@ -1098,6 +1099,13 @@ error:
   return NULL;
 }
 
+void * bpf_open_perf_buffer(perf_reader_raw_cb raw_cb,
+                            perf_reader_lost_cb lost_cb, void *cb_cookie,
+                            int pid, int cpu, int page_cnt) {
+  return bpf_open_perf_buffer_wakeup(raw_cb, lost_cb, cb_cookie,
+                                     pid, cpu, page_cnt, 1);
+}
+
 static int invalid_perf_config(uint32_t type, uint64_t config) {
   switch (type) {
   case PERF_TYPE_HARDWARE:
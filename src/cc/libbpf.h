@@ -84,6 +84,13 @@ int bpf_detach_tracepoint(const char *tp_category, const char *tp_name);
 void * bpf_open_perf_buffer(perf_reader_raw_cb raw_cb,
                             perf_reader_lost_cb lost_cb, void *cb_cookie,
                             int pid, int cpu, int page_cnt);
+/* As bpf_open_perf_buffer, but wake up the poller only once wakeup_events
+ * records have been posted, amortizing epoll wakeups for high-rate outputs.
+ */
+void * bpf_open_perf_buffer_wakeup(perf_reader_raw_cb raw_cb,
+                                   perf_reader_lost_cb lost_cb, void *cb_cookie,
+                                   int pid, int cpu, int page_cnt,
+                                   int wakeup_events);
 
 /* attached a prog expressed by progfd to the device specified in dev_name */
 int bpf_attach_xdp(const char *dev_name, int progfd, uint32_t flags);
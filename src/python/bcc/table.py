@@ -279,6 +279,11 @@ class TableBase(MutableMapping):
             raise StopIteration()
         return next_key
 
+    def _leaf_to_int(self, v):
+        # histogram count for one leaf; per-cpu tables override this to
+        # sum the value across cpus
+        return v.value
+
     def print_log2_hist(self, val_type="value", section_header="Bucket ptr",
             section_print_fn=None, bucket_fn=None, strip_leading_zero=None,
             bucket_sort_fn=None):
@@ -311,7 +316,7 @@ class TableBase(MutableMapping):
                     bucket = bucket_fn(bucket)
                 vals = tmp[bucket] = tmp.get(bucket, [0] * log2_index_max)
                 slot = getattr(k, f2)
-                vals[slot] = v.value
+                vals[slot] = self._leaf_to_int(v)
 
             buckets = list(tmp.keys())
             if bucket_sort_fn:
@@ -328,7 +333,7 @@ class TableBase(MutableMapping):
         else:
             vals = [0] * log2_index_max
             for k, v in self.items():
-                vals[k.value] = v.value
+                vals[k.value] = self._leaf_to_int(v)
             _print_log2_hist(vals, val_type, strip_leading_zero)
 
     def print_linear_hist(self, val_type="value", section_header="Bucket ptr",
@@ -360,7 +365,7 @@ class TableBase(MutableMapping):
                     bucket = bucket_fn(bucket)
                 vals = tmp[bucket] = tmp.get(bucket, [0] * linear_index_max)
                 slot = getattr(k, f2)
-                vals[slot] = v.value
+                vals[slot] = self._leaf_to_int(v)
 
             buckets = tmp.keys()
             if bucket_sort_fn:
@@ -378,7 +383,7 @@ class TableBase(MutableMapping):
             vals = [0] * linear_index_max
             for k, v in self.items():
                 try:
-                    vals[k.value] = v.value
+                    vals[k.value] = self._leaf_to_int(v)
                 except IndexError:
                     # Improve error text. If the limit proves a nusiance, this
                     # function be rewritten to avoid having one.
@@ -504,23 +509,30 @@ class PerfEventArray(ArrayBase):
             lib.bpf_close_perf_event_fd(self._open_key_fds[key])
         del self._open_key_fds[key]
 
-    def open_perf_buffer(self, callback, page_cnt=8, lost_cb=None):
+    def open_perf_buffer(self, callback, page_cnt=8, lost_cb=None,
+                         wakeup_events=1):
         """open_perf_buffers(callback)
 
         Opens a set of per-cpu ring buffer to receive custom perf event
         data from the bpf program. The callback will be invoked for each
         event submitted from the kernel, up to millions per second. Use
         page_cnt to change the size of the per-cpu ring buffer. The value
-        must be a power of two and defaults to 8.
+        must be a power of two and defaults to 8. Use wakeup_events to
+        only wake up the poller once that many events have been posted on
+        a cpu; values above 1 amortize epoll wakeups for high-rate event
+        streams, at the cost of delaying delivery of the last few events
+        until the next wakeup.
         """
 
         if page_cnt & (page_cnt - 1) != 0:
             raise Exception("Perf buffer page_cnt must be a power of two")
 
         for i in get_online_cpus():
-            self._open_perf_buffer(i, callback, page_cnt, lost_cb)
+            self._open_perf_buffer(i, callback, page_cnt, lost_cb,
+                                   wakeup_events)
 
-    def _open_perf_buffer(self, cpu, callback, page_cnt, lost_cb):
+    def _open_perf_buffer(self, cpu, callback, page_cnt, lost_cb,
+                          wakeup_events=1):
         def raw_cb_(_, data, size):
             try:
                 callback(cpu, data, size)
@@ -539,7 +551,8 @@ class PerfEventArray(ArrayBase):
                     raise e
         fn = _RAW_CB_TYPE(raw_cb_)
         lost_fn = _LOST_CB_TYPE(lost_cb_) if lost_cb else ct.cast(None, _LOST_CB_TYPE)
-        reader = lib.bpf_open_perf_buffer(fn, lost_fn, None, -1, cpu, page_cnt)
+        reader = lib.bpf_open_perf_buffer_wakeup(fn, lost_fn, None, -1, cpu,
+                                                 page_cnt, wakeup_events)
         if not reader:
             raise Exception("Could not open perf buffer")
         fd = lib.perf_reader_fd(reader)
@@ -620,6 +633,9 @@ class PerCpuHash(HashTable):
         result = self.sum(key)
         return result.value / self.total_cpu
 
+    def _leaf_to_int(self, v):
+        return sum(v)
+
 class LruPerCpuHash(PerCpuHash):
     def __init__(self, *args, **kwargs):
         super(LruPerCpuHash, self).__init__(*args, **kwargs)
@@ -680,6 +696,9 @@ class PerCpuArray(ArrayBase):
         result = self.sum(key)
         return result.value / self.total_cpu
 
+    def _leaf_to_int(self, v):
+        return sum(v)
+
 class LpmTrie(TableBase):
     def __init__(self, *args, **kwargs):
         super(LpmTrie, self).__init__(*args, **kwargs)
@@ -5,7 +5,7 @@
 #             For Linux, uses BCC, eBPF.
 #
 # USAGE: funcslower [-h] [-p PID] [-m MIN_MS] [-u MIN_US] [-a ARGUMENTS]
-#                   [-T] [-t] [-v] function [function ...]
+#                   [-o OUTLIER_MS] [-H] [-T] [-t] [-v] function [function ...]
 #
 # WARNING: This tool traces function calls by instrumenting the entry and
 # return from each function. For commonly-invoked functions like memory allocs
@@ -25,6 +25,8 @@ from __future__ import print_function
 from bcc import BPF
 import argparse
 import ctypes as ct
+import re
+import sys
 import time
 
 examples = """examples:
@@ -34,6 +36,9 @@ examples = """examples:
   ./funcslower -p 135 c:open   # trace pid 135 only
   ./funcslower c:malloc c:free # trace both malloc and free slower than 1ms
   ./funcslower -a 2 c:open     # show first two arguments to open
+  ./funcslower -H vfs_write    # also print a latency histogram on exit
+  ./funcslower -o 100 c:malloc # only print calls slower than 100ms,
+                               # histogram the rest in the kernel
 """
 parser = argparse.ArgumentParser(
     description="Trace slow kernel or user function calls.",
@@ -47,6 +52,11 @@ parser.add_argument("-u", "--min-us", type=float, dest="min_us",
     help="minimum duration to trace (us)")
 parser.add_argument("-a", "--arguments", type=int,
     help="print this many entry arguments, as hex")
+parser.add_argument("-o", "--outlier-ms", type=float, dest="outlier_ms",
+    help="only print calls slower than this many ms; calls above the "
+         "-m/-u threshold still count toward the latency histogram")
+parser.add_argument("-H", "--histogram", action="store_true",
+    help="print a log2 histogram of call latencies on exit")
 parser.add_argument("-T", "--time", action="store_true",
     help="show HH:MM:SS timestamp")
 parser.add_argument("-t", "--timestamp", action="store_true",
@@ -67,34 +77,70 @@ elif args.min_us:
 else:
     duration_ns = 1000000   # default to 1ms
 
+# individual events are only posted above the outlier threshold; it
+# defaults to the duration threshold, so every traced call still prints
+if args.outlier_ms:
+    outlier_ns = max(int(args.outlier_ms * 1000000), duration_ns)
+else:
+    outlier_ns = duration_ns
+
 bpf_text = """
 #include <uapi/linux/ptrace.h>
 #include <linux/sched.h>    // for TASK_COMM_LEN
 
 struct entry_t {
-    u64 id;
+    u64 ip;
     u64 start_ns;
 #ifdef GRAB_ARGS
     u64 args[6];
 #endif
 };
 
+struct comm_t {
+    char name[TASK_COMM_LEN];
+};
+
+// keep this struct lean: every field is copied into the perf buffer for
+// each event, so optional columns are only carried when requested
 struct data_t {
-    u64 id;
-    u64 tgid_pid;
+    u64 ip;
+#ifdef SHOW_START_NS
     u64 start_ns;
+#endif
     u64 duration_ns;
     u64 retval;
+    u32 tgid;
+    u32 pid;
     char comm[TASK_COMM_LEN];
 #ifdef GRAB_ARGS
     u64 args[6];
 #endif
 };
 
+// entry state must live in a plain hash: the return probe can fire on a
+// different cpu than the entry probe when the thread migrates mid-call,
+// so a percpu map would hand it another cpu's (zeroed) slot
 BPF_HASH(entryinfo, u64, struct entry_t);
 BPF_PERF_OUTPUT(events);
+// log2 histogram of latencies above the duration threshold, aggregated
+// in the kernel; per-cpu slots need no atomics on the increment
+BPF_PERCPU_ARRAY(lat_hist, u64, 64);
+// task comm cached per thread at entry, so the return path copies it
+// from the map instead of calling bpf_get_current_comm per event
+BPF_HASH(comm_cache, u32, struct comm_t);
+// thresholds are read from this array rather than compiled in, keeping
+// the program text identical across invocations and the values tunable
+// at runtime; slots per the CFG_* indices
+enum {
+    CFG_DURATION_NS,
+    CFG_OUTLIER_NS,
+};
+BPF_ARRAY(config, u64, 2);
 
-static int trace_entry(struct pt_regs *ctx, int id)
+// A single program serves every traced function: the function is identified
+// by its instruction pointer (as in vfscount), which avoids generating and
+// loading one trampoline per attached function.
+int trace_entry(struct pt_regs *ctx)
 {
     u64 tgid_pid = bpf_get_current_pid_tgid();
     u32 tgid = tgid_pid >> 32;
@@ -103,9 +149,18 @@ static int trace_entry(struct pt_regs *ctx, int id)
 
     u32 pid = tgid_pid;
 
-    struct entry_t entry = {};
+    // cache the comm once per thread lifetime; exec refreshes it below
+    if (!comm_cache.lookup(&pid)) {
+        struct comm_t comm = {};
+        bpf_get_current_comm(&comm.name, sizeof(comm.name));
+        comm_cache.update(&pid, &comm);
+    }
+
+    // no = {} zeroing: every field (and the args array, when compiled
+    // in) is stored below, so the verifier-mandated memset is dead work
+    struct entry_t entry;
     entry.start_ns = bpf_ktime_get_ns();
-    entry.id = id;
+    entry.ip = PT_REGS_IP(ctx);
 #ifdef GRAB_ARGS
     entry.args[0] = PT_REGS_PARM1(ctx);
     entry.args[1] = PT_REGS_PARM2(ctx);
@@ -133,40 +188,80 @@ int trace_return(struct pt_regs *ctx)
     u64 delta_ns = bpf_ktime_get_ns() - entryp->start_ns;
     entryinfo.delete(&tgid_pid);
 
-    if (delta_ns < DURATION_NS)
+    int cfg_key = CFG_DURATION_NS;
+    u64 *cfgp = config.lookup(&cfg_key);
+    if (cfgp && delta_ns < *cfgp)
         return 0;
 
-    struct data_t data = {};
-    data.id = entryp->id;
-    data.tgid_pid = tgid_pid;
+    int slot = bpf_log2l(delta_ns);
+    if (slot > 63)
+        slot = 63;
+    u64 *cnt = lat_hist.lookup(&slot);
+    if (cnt)
+        (*cnt)++;
+
+    // only calls above the outlier threshold are posted individually;
+    // with -o the common above-threshold case stays in the histogram
+    // and skips the perf submit entirely
+    cfg_key = CFG_OUTLIER_NS;
+    cfgp = config.lookup(&cfg_key);
+    if (cfgp && delta_ns < *cfgp)
+        return 0;
+
+    // every field of data_t is written below (comm and args by copy),
+    // and the struct has no padding holes, so skip the = {} zeroing
+    struct data_t data;
+    data.ip = entryp->ip;
+    data.tgid = tgid_pid >> 32;
+    data.pid = tgid_pid;
+#ifdef SHOW_START_NS
     data.start_ns = entryp->start_ns;
+#endif
     data.duration_ns = delta_ns;
     data.retval = PT_REGS_RC(ctx);
 #ifdef GRAB_ARGS
-    bpf_probe_read(&data.args[0], sizeof(data.args), entryp->args);
+    // entryp is a verified map value pointer, so a plain copy works and
+    // saves the bpf_probe_read helper call
+    __builtin_memcpy(&data.args[0], entryp->args, sizeof(data.args));
 #endif
-    bpf_get_current_comm(&data.comm, sizeof(data.comm));
+    u32 pid = tgid_pid;
+    struct comm_t *commp = comm_cache.lookup(&pid);
+    if (commp)
+        __builtin_memcpy(&data.comm, commp->name, sizeof(data.comm));
+    else
+        bpf_get_current_comm(&data.comm, sizeof(data.comm));
     events.perf_submit(ctx, &data, sizeof(data));
 
     return 0;
 }
+
+TRACEPOINT_PROBE(sched, sched_process_exec)
+{
+    // exec replaces the comm; invalidate the cached copy
+    u32 pid = bpf_get_current_pid_tgid();
+    comm_cache.delete(&pid);
+    return 0;
+}
+
+TRACEPOINT_PROBE(sched, sched_process_exit)
+{
+    // drop the dead thread's entry, so a recycled tid doesn't inherit
+    // its comm and the map doesn't fill up with exited threads
+    u32 pid = bpf_get_current_pid_tgid();
+    comm_cache.delete(&pid);
+    return 0;
+}
 """
 
-bpf_text = bpf_text.replace('DURATION_NS', str(duration_ns))
 if args.arguments:
     bpf_text = "#define GRAB_ARGS\n" + bpf_text
+if args.timestamp:
+    bpf_text = "#define SHOW_START_NS\n" + bpf_text
 if args.tgid:
     bpf_text = bpf_text.replace('TGID_FILTER', 'tgid != %d' % args.tgid)
 else:
     bpf_text = bpf_text.replace('TGID_FILTER', '0')
 
-for i in range(len(args.functions)):
-    bpf_text += """
-int trace_%d(struct pt_regs *ctx) {
-    return trace_entry(ctx, %d);
-}
-""" % (i, i)
-
 if args.verbose or args.ebpf:
     print(bpf_text)
     if args.ebpf:
@@ -174,27 +269,64 @@ if args.verbose or args.ebpf:
 
 b = BPF(text=bpf_text)
 
-for i, function in enumerate(args.functions):
+# populate the thresholds before attaching, so no event is matched
+# against an unset (zero) config
+config = b["config"]
+config[0] = config.Leaf(duration_ns)
+config[1] = config.Leaf(outlier_ns)
+
+# group user-space functions by library, so each library's symbol table
+# is scanned once for all of its probes rather than once per symbol per
+# probe direction
+user_funcs = {}
+for function in args.functions:
     if ":" in function:
         library, func = function.split(":")
-        b.attach_uprobe(name=library, sym=func, fn_name="trace_%d" % i)
-        b.attach_uretprobe(name=library, sym=func, fn_name="trace_return")
+        user_funcs.setdefault(library, []).append(func)
     else:
-        b.attach_kprobe(event=function, fn_name="trace_%d" % i)
+        b.attach_kprobe(event=function, fn_name="trace_entry")
         b.attach_kretprobe(event=function, fn_name="trace_return")
 
+for library, funcs in user_funcs.items():
+    pattern = ("^(%s)$" % "|".join(re.escape(f) for f in funcs)).encode()
+    addrs = dict(BPF.get_user_functions_and_addresses(library, pattern))
+    for func in funcs:
+        addr = addrs.get(func.encode())
+        if addr is None:
+            # not found by the symbol scan; let bcc's per-symbol
+            # resolver have a go and report the failure
+            b.attach_uprobe(name=library, sym=func, fn_name="trace_entry")
+            b.attach_uretprobe(name=library, sym=func,
+                fn_name="trace_return")
+        else:
+            b.attach_uprobe(name=library, addr=addr, fn_name="trace_entry")
+            b.attach_uretprobe(name=library, addr=addr,
+                fn_name="trace_return")
+
+# warm the symbol caches before events arrive: building a cache parses
+# kallsyms or /proc/<pid>/maps plus ELF symbol tables, which is better
+# paid at startup than inside the first print_event callback
+if not all(":" in f for f in args.functions):
+    b.ksym(0)
+if args.tgid and any(":" in f for f in args.functions):
+    b.sym(0, args.tgid)
+
 TASK_COMM_LEN = 16  # linux/sched.h
 
 class Data(ct.Structure):
-    _fields_ = [
-        ("id", ct.c_ulonglong),
-        ("tgid_pid", ct.c_ulonglong),
-        ("start_ns", ct.c_ulonglong),
+    _fields_ = [("ip", ct.c_ulonglong)] + \
+        ([("start_ns", ct.c_ulonglong)] if args.timestamp else []) + [
         ("duration_ns", ct.c_ulonglong),
         ("retval", ct.c_ulonglong),
+        ("tgid", ct.c_uint),
+        ("pid", ct.c_uint),
         ("comm", ct.c_char * TASK_COMM_LEN)
     ] + ([("args", ct.c_ulonglong * 6)] if args.arguments else [])
 
+# build the decoder once rather than re-creating the ctypes pointer type
+# inside the callback, which runs once per sample
+data_ptr_t = ct.POINTER(Data)
+
 time_designator = "us" if args.min_us else "ms"
 time_value = args.min_us or args.min_ms or 1
 time_multiplier = 1000 if args.min_us else 1000000
@@ -207,28 +339,82 @@ print((("%-10s " % "TIME" if time_col else "") + "%-14s %-6s %7s %16s %s") %
 
 earliest_ts = 0
 
-def time_str(event):
-    if args.time:
+# specialize the helpers once at startup: the -T/-t/-a branches are
+# loop-invariant, so pick the right variant here instead of re-testing
+# the flags on every event
+if args.time:
+    def time_str(event):
         return "%-10s " % time.strftime("%H:%M:%S")
-    if args.timestamp:
+elif args.timestamp:
+    def time_str(event):
         global earliest_ts
         if earliest_ts == 0:
             earliest_ts = event.start_ns
         return "%-10.6f " % ((event.start_ns - earliest_ts) / 1000000000.0)
-    return ""
+else:
+    def time_str(event):
+        return ""
 
-def args_str(event):
-    if not args.arguments:
+kernel_only = not any(":" in f for f in args.functions)
+name_cache = {}  # (addr, tgid) -> function name
+
+def func_name(event):
+    # resolve the entry instruction pointer recorded by the shared entry
+    # program back to a function name; on 64-bit kernels text addresses
+    # have the top bit set, which disambiguates mixed user/kernel traces.
+    # the same handful of addresses recurs on every event, so cache the
+    # resolutions and only hit the symbol resolver on the first sighting
+    if kernel_only or event.ip & (1 << 63):
+        key = (event.ip, -1)
+    else:
+        key = (event.ip, event.tgid)
+    name = name_cache.get(key)
+    if name is None:
+        if key[1] < 0:
+            name = b.ksym(event.ip).decode()
+        else:
+            name = b.sym(event.ip, event.tgid).decode()
+        name_cache[key] = name
+    return name
+
+if args.arguments:
+    def args_str(event):
+        return str.join(" ",
+            ["0x%x" % arg for arg in event.args[:args.arguments]])
+else:
+    def args_str(event):
         return ""
-    return str.join(" ", ["0x%x" % arg for arg in event.args[:args.arguments]])
+
+line_fmt = "%s%-14.14s %-6s %7.2f %16x %s %s\n"
 
 def print_event(cpu, data, size):
-    event = ct.cast(data, ct.POINTER(Data)).contents
-    ts = float(event.duration_ns) / time_multiplier
-    print((time_str(event) + "%-14.14s %-6s %7.2f %16x %s %s") %
-        (event.comm.decode(), event.tgid_pid >> 32,
-         ts, event.retval, args.functions[event.id], args_str(event)))
-
-b["events"].open_perf_buffer(print_event, page_cnt=64)
-while True:
-    b.perf_buffer_poll()
+    event = ct.cast(data, data_ptr_t).contents
+    sys.stdout.write(line_fmt % (time_str(event), event.comm.decode(),
+        event.tgid, float(event.duration_ns) / time_multiplier,
+        event.retval, func_name(event), args_str(event)))
+
+def print_lost(lost):
+    print("Possibly lost %d events" % lost, file=sys.stderr)
+
+# keep the default wakeup_events of 1: batching wakeups would leave
+# low-rate traces (the common case) blocked in poll indefinitely, and
+# records short of the batch would be dropped at Ctrl-C.
+# 64 pages per cpu is plenty for the post-threshold event stream while
+# keeping the locked memory modest on many-cpu machines.
+b["events"].open_perf_buffer(print_event, page_cnt=64, lost_cb=print_lost)
+# let event lines accumulate in the stdio buffer and flush once per poll
+# batch, rather than flushing per line when stdout is a tty
+if hasattr(sys.stdout, "reconfigure"):
+    sys.stdout.reconfigure(line_buffering=False)
+try:
+    while True:
+        b.perf_buffer_poll()
+        sys.stdout.flush()
+except (KeyboardInterrupt, SystemExit):
+    # perf_buffer_poll turns Ctrl-C into SystemExit; catch it so the
+    # histogram can still be printed below
+    pass
+
+if args.histogram or args.outlier_ms:
+    print()
+    b["lat_hist"].print_log2_hist("nsecs")
@@ -29,9 +29,11 @@
 
 from __future__ import print_function
 from bcc import BPF, PerfType, PerfSWConfig
-from sys import stderr
+from operator import itemgetter
+from sys import stderr, stdout
 from time import sleep
 import argparse
+import re
 import signal
 import os
 import errno
@@ -84,6 +86,9 @@ stack_group.add_argument("-K", "--kernel-stacks-only", action="store_true",
     help="show stacks from kernel space only (no user space stacks)")
 parser.add_argument("-F", "--frequency", type=positive_int, default=49,
     help="sample frequency, Hertz (default 49)")
+parser.add_argument("-m", "--min-ms", type=float, default=1, dest="min_ms",
+    help="only sample function calls that have been running longer than "
+        "this (ms, default 1)")
 parser.add_argument("-d", "--delimited", action="store_true",
     help="insert delimiter between kernel/user stacks")
 parser.add_argument("-v", "--verbose", action="store_true",
@@ -124,7 +129,7 @@ bpf_text = """
 #include <linux/sched.h>
 
 struct entry_t {
-    u64 id;
+    u64 ip;
     u64 start_ns;
 #ifdef GRAB_ARGS
     u64 args[6];
@@ -132,7 +137,7 @@ struct entry_t {
 };
 
 struct data_t {
-    u64 id;
+    u64 ip;
     u64 tgid_pid;
     u64 start_ns;
     u64 duration_ns;
@@ -143,6 +148,10 @@ struct data_t {
 #endif
 };
 
+struct comm_t {
+    char name[TASK_COMM_LEN];
+};
+
 struct key_t {
     u32 pid;
     u64 kernel_ip;
@@ -152,11 +161,27 @@ struct key_t {
     char name[TASK_COMM_LEN];
 };
 
+// entry state must live in a plain hash: the sampler and return probe
+// can fire on a different cpu than the entry probe when the thread
+// migrates mid-call, so a percpu map would hand them another cpu's
+// (zeroed) slot
 BPF_HASH(entryinfo, u64, struct entry_t);
-BPF_HASH(counts, struct key_t);
+// per-cpu counts skip the bucket spinlock on every sampled increment;
+// userspace sums the per-cpu values once at report time
+BPF_TABLE("percpu_hash", struct key_t, u64, counts, 10240);
 BPF_STACK_TRACE(stack_traces, STACK_STORAGE_SIZE);
-
-static int trace_entry(struct pt_regs *ctx, int id)
+// task comm cached per thread at entry, so each sample copies it from
+// the map instead of calling bpf_get_current_comm
+BPF_HASH(comm_cache, u32, struct comm_t);
+// the duration threshold is read from this array rather than compiled
+// in, keeping the program text identical across invocations and the
+// value tunable at runtime
+BPF_ARRAY(config, u64, 1);
+
+// A single program serves every traced function: the function is identified
+// by its instruction pointer (as in vfscount), which avoids generating and
+// loading one trampoline per attached function.
+int trace_entry(struct pt_regs *ctx)
 {
     u64 tgid_pid = bpf_get_current_pid_tgid();
     u32 tgid = tgid_pid >> 32;
@@ -165,9 +190,18 @@ static int trace_entry(struct pt_regs *ctx, int id)
 
     u32 pid = tgid_pid;
 
-    struct entry_t entry = {};
+    // cache the comm once per thread lifetime; exec refreshes it below
+    if (!comm_cache.lookup(&pid)) {
+        struct comm_t comm = {};
+        bpf_get_current_comm(&comm.name, sizeof(comm.name));
+        comm_cache.update(&pid, &comm);
+    }
+
+    // no = {} zeroing: every live field is stored below, so the
+    // verifier-mandated memset is dead work
+    struct entry_t entry;
     entry.start_ns = bpf_ktime_get_ns();
-    entry.id = id;
+    entry.ip = PT_REGS_IP(ctx);
 #ifdef GRAB_ARGS
     entry.args[0] = PT_REGS_PARM1(ctx);
     entry.args[1] = PT_REGS_PARM2(ctx);
@@ -215,23 +249,29 @@ int do_perf_event(struct bpf_perf_event_data *ctx) {
 
     u64 delta_ns = bpf_ktime_get_ns() - entryp->start_ns;
 
-    if (delta_ns < DURATION_NS)
+    int cfg_key = 0;
+    u64 *cfgp = config.lookup(&cfg_key);
+    if (cfgp && delta_ns < *cfgp)
         return 0;
 
     // create map key
     u64 zero = 0, *val;
     struct key_t key = {.pid = pid};
-    bpf_get_current_comm(&key.name, sizeof(key.name));
+    u32 tid = tgid_pid;
+    struct comm_t *commp = comm_cache.lookup(&tid);
+    if (commp)
+        __builtin_memcpy(&key.name, commp->name, sizeof(key.name));
+    else
+        bpf_get_current_comm(&key.name, sizeof(key.name));
 
     // get stacks
     key.user_stack_id = USER_STACK_GET;
     key.kernel_stack_id = KERNEL_STACK_GET;
 
     if (key.kernel_stack_id >= 0) {
-        // populate extras to fix the kernel stack
-        struct pt_regs regs = {};
-        bpf_probe_read(&regs, sizeof(regs), (void *)&ctx->regs);
-        u64 ip = PT_REGS_IP(&regs);
+        // populate extras to fix the kernel stack; perf event programs
+        // can read ctx->regs directly (4.9+), no bpf_probe_read needed
+        u64 ip = PT_REGS_IP(&ctx->regs);
         u64 page_offset;
 
         // if ip isn't sane, leave key ips as zero for later checking
@@ -260,6 +300,23 @@ int do_perf_event(struct bpf_perf_event_data *ctx) {
     (*val)++;
     return 0;
 }
+
+TRACEPOINT_PROBE(sched, sched_process_exec)
+{
+    // exec replaces the comm; invalidate the cached copy
+    u32 tid = bpf_get_current_pid_tgid();
+    comm_cache.delete(&tid);
+    return 0;
+}
+
+TRACEPOINT_PROBE(sched, sched_process_exit)
+{
+    // drop the dead thread's entry, so a recycled tid doesn't inherit
+    // its comm and the map doesn't fill up with exited threads
+    u32 tid = bpf_get_current_pid_tgid();
+    comm_cache.delete(&tid);
+    return 0;
+}
 """
 
 # set thread filter
@@ -296,9 +353,9 @@ bpf_text = bpf_text.replace('USER_STACK_GET', user_stack_get)
 bpf_text = bpf_text.replace('KERNEL_STACK_GET', kernel_stack_get)
 
 
-# TODO: make duration_ns and tgid parameters
-duration_ns = 1000000   # default to 1ms
-bpf_text = bpf_text.replace('DURATION_NS', str(duration_ns))
+# TODO: make tgid a parameter
+# fractions are allowed, but rounded to an integer nanosecond
+duration_ns = int(args.min_ms * 1000000)
 bpf_text = bpf_text.replace('TGID_FILTER', '0')
 
 # header
@@ -310,14 +367,6 @@ if not args.folded:
     else:
         print("... Hit Ctrl-C to end.")
 
-for i in range(len(args.functions)):
-    bpf_text += """
-int trace_%d(struct pt_regs *ctx) {
-    return trace_entry(ctx, %d);
-}
-""" % (i, i)
-
-
 if debug or args.ebpf:
     print(bpf_text)
     if args.ebpf:
@@ -325,19 +374,44 @@ if debug or args.ebpf:
 
 # initialize BPF & perf_events
 b = BPF(text=bpf_text)
+
+# populate the threshold before attaching, so no sample is matched
+# against an unset (zero) config
+config = b["config"]
+config[0] = config.Leaf(duration_ns)
+
 b.attach_perf_event(ev_type=PerfType.SOFTWARE,
     ev_config=PerfSWConfig.CPU_CLOCK, fn_name="do_perf_event",
     sample_period=0, sample_freq=args.frequency)
 
-for i, function in enumerate(args.functions):
+# group user-space functions by library, so each library's symbol table
+# is scanned once for all of its probes rather than once per symbol per
+# probe direction
+user_funcs = {}
+for function in args.functions:
     if ":" in function:
         library, func = function.split(":")
-        b.attach_uprobe(name=library, sym=func, fn_name="trace_%d" % i)
-        b.attach_uretprobe(name=library, sym=func, fn_name="trace_return")
+        user_funcs.setdefault(library, []).append(func)
     else:
-        b.attach_kprobe(event=function, fn_name="trace_%d" % i)
+        b.attach_kprobe(event=function, fn_name="trace_entry")
         b.attach_kretprobe(event=function, fn_name="trace_return")
 
+for library, funcs in user_funcs.items():
+    pattern = ("^(%s)$" % "|".join(re.escape(f) for f in funcs)).encode()
+    addrs = dict(BPF.get_user_functions_and_addresses(library, pattern))
+    for func in funcs:
+        addr = addrs.get(func.encode())
+        if addr is None:
+            # not found by the symbol scan; let bcc's per-symbol
+            # resolver have a go and report the failure
+            b.attach_uprobe(name=library, sym=func, fn_name="trace_entry")
+            b.attach_uretprobe(name=library, sym=func,
+                fn_name="trace_return")
+        else:
+            b.attach_uprobe(name=library, addr=addr, fn_name="trace_entry")
+            b.attach_uretprobe(name=library, addr=addr,
+                fn_name="trace_return")
+
 
 # signal handler
 def signal_ignore(signal, frame):
@@ -357,18 +431,51 @@ except KeyboardInterrupt:
 if not args.folded:
     print()
 
+# the same addresses recur across most sampled stacks, so cache the
+# resolved names and pay the symbol resolver cost once per address
+ksym_cache = {}
+sym_cache = {}
+
 def aksym(addr):
-    if args.annotations:
-        return b.ksym(addr) + "_[k]"
-    else:
-        return b.ksym(addr)
+    name = ksym_cache.get(addr)
+    if name is None:
+        name = b.ksym(addr).decode()
+        if args.annotations:
+            name += "_[k]"
+        ksym_cache[addr] = name
+    return name
+
+def usym(addr, pid):
+    name = sym_cache.get((addr, pid))
+    if name is None:
+        name = b.sym(addr, pid).decode()
+        sym_cache[(addr, pid)] = name
+    return name
 
 # output stacks
 missing_stacks = 0
 has_enomem = False
 counts = b.get_table("counts")
 stack_traces = b.get_table("stack_traces")
-for k, v in sorted(counts.items(), key=lambda counts: counts[1].value):
+
+# fetch each unique stack id from the kernel once: ids are shared between
+# keys (BPF_F_REUSE_STACKID), so caching the frames avoids a map lookup
+# syscall for every key that references an already-seen stack
+stack_frames = {}
+def get_stack(stack_id):
+    if stack_id not in stack_frames:
+        stack_frames[stack_id] = tuple(stack_traces.walk(stack_id))
+    return stack_frames[stack_id]
+
+# sum the per-cpu counts and sort plain ints; with large
+# --stack-storage-size this avoids per-element ctypes accesses inside
+# the sort and reuses the extracted value when printing
+entries = [(k, sum(v)) for k, v in counts.items()]
+entries.sort(key=itemgetter(1))
+# report lines are accumulated and written in one go below, rather than
+# one print (and potentially one write syscall) per line
+out = []
+for k, count in entries:
     # handle get_stackid erorrs
     if (not args.user_stacks_only and k.kernel_stack_id < 0 and
             k.kernel_stack_id != -errno.EFAULT) or \
@@ -380,41 +487,38 @@ for k, v in sorted(counts.items(), key=lambda counts: counts[1].value):
                 k.user_stack_id == -errno.ENOMEM:
             has_enomem = True
 
-    user_stack = [] if k.user_stack_id < 0 else \
-        stack_traces.walk(k.user_stack_id)
-    kernel_tmp = [] if k.kernel_stack_id < 0 else \
-        stack_traces.walk(k.kernel_stack_id)
+    # the cached frames are tuples, which reversed() walks without
+    # copying; only a sane sampled ip forces a new tuple for the fix-up
+    user_stack = () if k.user_stack_id < 0 else \
+        get_stack(k.user_stack_id)
+    kernel_stack = () if k.kernel_stack_id < 0 else \
+        get_stack(k.kernel_stack_id)
 
-    # fix kernel stack
-    kernel_stack = []
-    if k.kernel_stack_id >= 0:
-        for addr in kernel_tmp:
-            kernel_stack.append(addr)
-        # the later IP checking
-        if k.kernel_ip:
-            kernel_stack.insert(0, k.kernel_ip)
+    # fix the kernel stack with the sampled ip (the later IP checking)
+    if k.kernel_stack_id >= 0 and k.kernel_ip:
+        kernel_stack = (k.kernel_ip,) + kernel_stack
 
     do_delimiter = need_delimiter and kernel_stack
 
     if args.folded:
-        # print folded stack output
-        user_stack = list(user_stack)
-        kernel_stack = list(kernel_stack)
+        # emit folded stack output
         line = [k.name.decode()] + \
-            [b.sym(addr, k.pid) for addr in reversed(user_stack)] + \
+            [usym(addr, k.pid) for addr in reversed(user_stack)] + \
             (do_delimiter and ["-"] or []) + \
             [aksym(addr) for addr in reversed(kernel_stack)]
-        print("%s %d" % (";".join(line), v.value))
+        out.append("%s %d\n" % (";".join(line), count))
     else:
-        # print default multi-line stack output.
+        # emit default multi-line stack output.
         for addr in kernel_stack:
-            print("    %s" % aksym(addr))
+            out.append("    %s\n" % aksym(addr))
         if do_delimiter:
-            print("    --")
+            out.append("    --\n")
         for addr in user_stack:
-            print("    %s" % b.sym(addr, k.pid))
-        print("    %-16s %s (%d)" % ("-", k.name.decode(), k.pid))
-        print("        %d\n" % v.value)
+            out.append("    %s\n" % usym(addr, k.pid))
+        out.append("    %-16s %s (%d)\n" % ("-", k.name.decode(), k.pid))
+        out.append("        %d\n\n" % count)
+
+stdout.write("".join(out))
 
 # check missing
 if missing_stacks > 0: